@@ -4,103 +4,348 @@ Container Restarter - Automatically restart a Docker container at a scheduled ti
 """
 
 import os
+import re
+import functools
+import json
+import string
+import tempfile
 import time
-import requests
+import http.client
 import logging
 from datetime import datetime, timedelta
+from urllib.parse import urlsplit, urlencode
 import sys
 
+try:
+    import ijson
+except ImportError:
+    # Optional: stream the container list instead of decoding it all at once
+    ijson = None
+
+
+@functools.lru_cache(maxsize=1)
+def _format_second(seconds):
+    """Format a timestamp to the second, cached for records logged in the same second"""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(seconds))
+
+
+class CachedTimeFormatter(logging.Formatter):
+    """Log formatter that builds each second's timestamp only once"""
+
+    def formatTime(self, record, datefmt=None):
+        if datefmt:
+            return super().formatTime(record, datefmt)
+
+        return f"{_format_second(int(record.created))},{int(record.msecs):03d}"
+
+
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(CachedTimeFormatter('{asctime} - {levelname} - {message}', style='{'))
+logging.getLogger().addHandler(log_handler)
+logging.getLogger().setLevel(logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Upper bound on a single sleep between schedule checks (seconds)
+MAX_SLEEP = 3600
+
+# Upper bound on the retry delay after repeated errors (seconds)
+MAX_BACKOFF = 600
+
+# Delays before retrying a GET request that hit a gateway error (seconds)
+GATEWAY_RETRY_DELAYS = (0.5, 1, 2)
+
+# Timeout for connecting to Portainer, separate from per-request read timeouts (seconds)
+CONNECT_TIMEOUT = 5
+
+
+class ContainerNotFoundError(ValueError):
+    """Raised when the configured container does not exist"""
+
+
+class PortainerHTTPError(Exception):
+    """Raised when Portainer answers with an error status"""
+
+    def __init__(self, status_code, reason, path):
+        super().__init__(f"{status_code} {reason} for {path}")
+        self.status_code = status_code
+
 
 class PortainerAPI:
     """Wrapper for Portainer API operations"""
 
-    def __init__(self, url, api_key=None, username=None, password=None):
+    def __init__(self, url, endpoint_id, api_key=None, username=None, password=None):
         self.url = url.rstrip('/')
         self.api_key = api_key
         self.username = username
         self.password = password
         self.jwt_token = None
-        self.jwt_expiry = None
+        self.jwt_expiry_mono = None  # time.monotonic() deadline, immune to clock changes
+        self.token_cache_path = os.path.join(
+            os.getenv('XDG_STATE_HOME', '/tmp'),
+            'container-restarter-jwt.json'
+        )
+
+        # A single connection to Portainer is kept alive between checks
+        parts = urlsplit(self.url)
+        if parts.scheme == 'https':
+            self._conn = http.client.HTTPSConnection(
+                parts.hostname, parts.port, timeout=CONNECT_TIMEOUT
+            )
+        else:
+            self._conn = http.client.HTTPConnection(
+                parts.hostname, parts.port, timeout=CONNECT_TIMEOUT
+            )
+        self._base_path = parts.path
+        self._containers_path = f"{self._base_path}/api/endpoints/{endpoint_id}/docker/containers"
+
+        # Auth headers are built once instead of on every request
+        self._static_headers = {'X-API-Key': self.api_key} if self.api_key else None
+        self._jwt_header = None
+        if not self.api_key:
+            self._load_cached_token()
+
+        if self.username and self.password:
+            self._auth_body = json.dumps({
+                'username': self.username,
+                'password': self.password
+            }).encode()
+
+    def close(self):
+        """Close the connection to Portainer"""
+        self._conn.close()
 
     def _get_headers(self):
         """Get authentication headers for API requests"""
-        if self.api_key:
-            return {'X-API-Key': self.api_key}
+        if self._static_headers is not None:
+            return self._static_headers
 
-        # Use JWT authentication
-        if not self.jwt_token or datetime.now() >= self.jwt_expiry:
+        return self._jwt_headers()
+
+    def _jwt_headers(self):
+        """Get JWT authentication headers, refreshing the token if needed"""
+        # Refresh a token that would expire mid-request
+        if not self.jwt_token or time.monotonic() + 60 >= self.jwt_expiry_mono:
             self._authenticate()
 
-        return {'Authorization': f'Bearer {self.jwt_token}'}
+        return self._jwt_header
+
+    def _set_token(self, jwt_token, ttl):
+        """Store a JWT token valid for ttl seconds"""
+        self.jwt_token = jwt_token
+        self.jwt_expiry_mono = time.monotonic() + ttl
+        self._jwt_header = {'Authorization': f'Bearer {jwt_token}'}
+
+    def _send(self, method, path, body=None, headers=None, timeout=10):
+        """Send a request on the persistent connection and return the response"""
+        headers = headers or {}
+
+        for attempt in range(2):
+            try:
+                if self._conn.sock is None:
+                    self._conn.connect()
+                self._conn.sock.settimeout(timeout)
+                self._conn.request(method, path, body=body, headers=headers)
+                return self._conn.getresponse()
+            except (ConnectionResetError, BrokenPipeError):
+                # Portainer dropped the idle connection, reconnect and retry once
+                self._conn.close()
+                if attempt:
+                    raise
+            except Exception:
+                self._conn.close()
+                raise
+
+    def _request(self, method, path, params=None, timeout=10):
+        """Send an authenticated request, raising PortainerHTTPError on an error status
+
+        The response body must be read before the next request is sent.
+        """
+        if params:
+            path = f"{path}?{urlencode(params)}"
+
+        headers = self._get_headers()
+        response = self._send(method, path, headers=headers, timeout=timeout)
+
+        if response.status == 401 and not self.api_key:
+            logger.info("Portainer rejected the JWT token, re-authenticating")
+            response.read()
+            self._authenticate()
+            headers = self._jwt_header
+            response = self._send(method, path, headers=headers, timeout=timeout)
+
+        # Only GET requests are safe to retry
+        for delay in GATEWAY_RETRY_DELAYS if method == 'GET' else ():
+            if response.status not in (502, 503, 504):
+                break
+            response.read()
+            time.sleep(delay)
+            response = self._send(method, path, headers=headers, timeout=timeout)
+
+        if response.status >= 400:
+            response.read()
+            raise PortainerHTTPError(response.status, response.reason, path)
+
+        return response
 
     def _authenticate(self):
         """Authenticate and obtain JWT token"""
         if not self.username or not self.password:
             raise ValueError("Either API_KEY or USERNAME and PASSWORD must be provided")
 
-        auth_url = f"{self.url}/api/auth"
-        payload = {
-            'username': self.username,
-            'password': self.password
-        }
+        auth_path = f"{self._base_path}/api/auth"
 
         try:
-            response = requests.post(auth_url, json=payload, timeout=10)
-            response.raise_for_status()
-            data = response.json()
-            self.jwt_token = data['jwt']
+            response = self._send(
+                'POST',
+                auth_path,
+                body=self._auth_body,
+                headers={'Content-Type': 'application/json'}
+            )
+            body = response.read()
+            if response.status >= 400:
+                raise PortainerHTTPError(response.status, response.reason, auth_path)
+            data = json.loads(body)
             # JWT token expires in 8 hours, refresh 30 minutes before
-            self.jwt_expiry = datetime.now() + timedelta(hours=7, minutes=30)
+            self._set_token(data['jwt'], 7 * 3600 + 30 * 60)
             logger.info("Successfully authenticated with Portainer")
         except Exception as e:
             logger.error(f"Authentication failed: {e}")
             raise
 
-    def get_container_id(self, endpoint_id, container_name):
+        self._save_cached_token()
+
+    def _load_cached_token(self):
+        """Load a JWT token saved by a previous run, if it is still valid"""
+        try:
+            with open(self.token_cache_path) as f:
+                data = json.load(f)
+
+            if data['url'] != self.url or data['username'] != self.username:
+                return
+
+            # The on-disk expiry has to be wall-clock time to survive a restart
+            ttl = (datetime.fromisoformat(data['expiry']) - datetime.now()).total_seconds()
+            if ttl <= 0:
+                return
+
+            self._set_token(data['jwt'], ttl)
+            logger.info("Using cached Portainer token")
+        except Exception:
+            # Missing or unreadable cache, authenticate normally
+            pass
+
+    def _save_cached_token(self):
+        """Save the JWT token so it can be reused after a restart"""
+        data = {
+            'url': self.url,
+            'username': self.username,
+            'jwt': self.jwt_token,
+            'expiry': (
+                datetime.now() + timedelta(seconds=self.jwt_expiry_mono - time.monotonic())
+            ).isoformat()
+        }
+
+        try:
+            # mkstemp creates the file with mode 0600
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(self.token_cache_path),
+                prefix='.container-restarter-jwt-'
+            )
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, self.token_cache_path)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+        except Exception as e:
+            logger.warning(f"Failed to cache token: {e}")
+
+    def get_container_id(self, container_name):
         """Get container ID from container name"""
-        url = f"{self.url}/api/endpoints/{endpoint_id}/docker/containers/json?all=1"
-        headers = self._get_headers()
+        path = f"{self._containers_path}/json"
+        container_name = container_name.lstrip('/')
 
         try:
-            response = requests.get(url, headers=headers, timeout=10)
-            response.raise_for_status()
-            containers = response.json()
-
-            for container in containers:
-                # Container names start with '/', so we check both formats
-                names = container.get('Names', [])
-                if f'/{container_name}' in names or container_name in names:
-                    return container['Id']
-                # Also check if the provided name is already an ID
-                if container['Id'].startswith(container_name):
-                    return container['Id']
-
-            raise ValueError(f"Container '{container_name}' not found")
+            # Let Docker match the name so only that container is returned
+            params = {
+                'all': 1,
+                'filters': json.dumps({'name': [f'^/{re.escape(container_name)}$']})
+            }
+            response = self._request('GET', path, params=params)
+            containers = json.loads(response.read())
+
+            if containers:
+                return containers[0]['Id']
+
+            # Only an ID prefix needs the full container list
+            if len(container_name) < 12 or not all(c in string.hexdigits for c in container_name):
+                raise ContainerNotFoundError(f"Container '{container_name}' not found")
+
+            response = self._request('GET', path, params={'all': 1})
+            try:
+                if ijson:
+                    containers = ijson.items(response, 'item')
+                else:
+                    containers = json.loads(response.read())
+
+                # Docker container names always start with '/'
+                wanted = '/' + container_name
+                for container in containers:
+                    if wanted in (container.get('Names') or ()):
+                        return container['Id']
+                    # Also check if the provided name is already an ID
+                    if container['Id'].startswith(container_name):
+                        return container['Id']
+            finally:
+                # Drain whatever is left so the connection can be reused
+                response.read()
+
+            raise ContainerNotFoundError(f"Container '{container_name}' not found")
         except Exception as e:
-            logger.error(f"Failed to get container ID: {e}")
+            logger.error("Failed to get container ID: %s", e)
             raise
 
-    def restart_container(self, endpoint_id, container_id):
+    def restart_container(self, container_id):
         """Restart a container"""
-        url = f"{self.url}/api/endpoints/{endpoint_id}/docker/containers/{container_id}/restart"
-        headers = self._get_headers()
+        path = f"{self._containers_path}/{container_id}/restart"
+        started = time.monotonic()
 
         try:
-            response = requests.post(url, headers=headers, timeout=30)
-            response.raise_for_status()
-            logger.info(f"Successfully restarted container {container_id}")
-            return True
+            # Docker waits for the container to stop before answering
+            response = self._request('POST', path, timeout=60)
+            response.read()
+            logger.info("Successfully restarted container %s", container_id)
         except Exception as e:
-            logger.error(f"Failed to restart container: {e}")
+            logger.error("Failed to restart container: %s", e)
             raise
 
+        self._wait_until_running(container_id, started)
+        return True
+
+    def _wait_until_running(self, container_id, started, attempts=5):
+        """Poll the container state until it is running again"""
+        path = f"{self._containers_path}/{container_id}/json"
+
+        try:
+            for _ in range(attempts):
+                response = self._request('GET', path)
+                status = json.loads(response.read())['State']['Status']
+                if status == 'running':
+                    logger.info(
+                        "Container %s is running after %.1f seconds",
+                        container_id,
+                        time.monotonic() - started
+                    )
+                    return
+                time.sleep(1)
+
+            logger.warning("Container %s is not running yet (status: %s)", container_id, status)
+        except Exception as e:
+            # The restart itself succeeded, so don't report it as failed
+            logger.warning("Failed to check container status: %s", e)
+
 
 class ContainerRestarter:
     """Scheduler for container restarts"""
@@ -113,12 +358,13 @@ class ContainerRestarter:
         self.endpoint_id = os.getenv('ENDPOINT_ID', '1')
         self.container_name = os.getenv('CONTAINER_NAME')
         self.restart_time = os.getenv('RESTART_TIME', '03:00')
-        self.check_interval = int(os.getenv('CHECK_INTERVAL', '60'))  # seconds
+        self.check_interval = os.getenv('CHECK_INTERVAL', '60')  # seconds between retries
 
         self._validate_config()
 
         self.api = PortainerAPI(
             url=self.portainer_url,
+            endpoint_id=self.endpoint_id,
             api_key=self.api_key,
             username=self.username,
             password=self.password
@@ -126,6 +372,7 @@ class ContainerRestarter:
 
         self.container_id = None
         self.last_restart_date = None
+        self._fail_count = 0
 
     def _validate_config(self):
         """Validate required environment variables"""
@@ -141,6 +388,19 @@ class ContainerRestarter:
         if not self.container_name:
             raise ValueError("CONTAINER_NAME environment variable is required")
 
+        try:
+            self.endpoint_id = int(self.endpoint_id)
+        except ValueError:
+            raise ValueError(f"ENDPOINT_ID must be an integer, got: {self.endpoint_id}")
+
+        try:
+            self.check_interval = int(self.check_interval)
+        except ValueError:
+            raise ValueError(f"CHECK_INTERVAL must be an integer, got: {self.check_interval}")
+
+        if self.check_interval < 1:
+            raise ValueError(f"CHECK_INTERVAL must be at least 1 second, got: {self.check_interval}")
+
         # Validate time format
         try:
             datetime.strptime(self.restart_time, '%H:%M')
@@ -149,68 +409,115 @@ class ContainerRestarter:
                 f"RESTART_TIME must be in HH:MM format (24-hour), got: {self.restart_time}"
             )
 
-    def _should_restart(self):
-        """Check if it's time to restart the container"""
-        now = datetime.now()
-        target_time = datetime.strptime(self.restart_time, '%H:%M').time()
-        current_time = now.time()
-        current_date = now.date()
-
-        # Check if we're within the time window and haven't restarted today
-        time_match = (
-            current_time.hour == target_time.hour and
-            current_time.minute == target_time.minute
+        # Parse once so the check loop only compares integers
+        self._target_hour, self._target_minute = map(int, self.restart_time.split(':'))
+
+    def _target_time(self, now):
+        """Get today's scheduled restart time"""
+        return now.replace(
+            hour=self._target_hour,
+            minute=self._target_minute,
+            second=0,
+            microsecond=0
         )
 
-        not_restarted_today = self.last_restart_date != current_date
+    def _should_restart(self, now):
+        """Check if it's time to restart the container"""
+        target = self._target_time(now)
+
+        # Accept a window rather than the exact minute, wide enough for a
+        # failed attempt to be retried once after CHECK_INTERVAL
+        window = timedelta(seconds=2 * max(self.check_interval, 60))
+        time_match = target <= now < target + window
+
+        not_restarted_today = self.last_restart_date != now.date()
 
         return time_match and not_restarted_today
 
+    def _seconds_until_next_restart(self, now):
+        """Get the number of seconds until the next scheduled restart"""
+        target = self._target_time(now)
+
+        if target <= now or self.last_restart_date == now.date():
+            target += timedelta(days=1)
+
+        return (target - now).total_seconds()
+
     def run(self):
         """Main loop to check and restart container"""
-        logger.info("Container Restarter starting...")
-        logger.info(f"Portainer URL: {self.portainer_url}")
-        logger.info(f"Endpoint ID: {self.endpoint_id}")
-        logger.info(f"Container: {self.container_name}")
-        logger.info(f"Scheduled restart time: {self.restart_time}")
-        logger.info(f"Check interval: {self.check_interval} seconds")
+        logger.info(
+            "Container Restarter starting...\n"
+            f"Portainer URL: {self.portainer_url}\n"
+            f"Endpoint ID: {self.endpoint_id}\n"
+            f"Container: {self.container_name}\n"
+            f"Scheduled restart time: {self.restart_time}\n"
+            f"Retry interval: {self.check_interval} seconds"
+        )
 
         # Get container ID once at startup
         try:
-            self.container_id = self.api.get_container_id(
-                self.endpoint_id,
-                self.container_name
-            )
+            self.container_id = self.api.get_container_id(self.container_name)
             logger.info(f"Found container ID: {self.container_id[:12]}...")
         except Exception as e:
             logger.error(f"Failed to find container at startup: {e}")
-            logger.info("Will retry on each check...")
+            logger.info("Will retry at the scheduled restart time...")
+
+        try:
+            self._loop()
+        finally:
+            self.api.close()
+
+    def _do_restart(self, now):
+        """Restart the container, resolving its ID first if needed"""
+        if not self.container_id:
+            self.container_id = self.api.get_container_id(self.container_name)
+            logger.info("Resolved container ID: %.12s...", self.container_id)
+
+        logger.info("Time to restart container %s", self.container_name)
+        self.api.restart_container(self.container_id)
+        self.last_restart_date = now.date()
+        logger.info("Next restart scheduled for %s tomorrow", self.restart_time)
+
+    @staticmethod
+    def _is_not_found(error):
+        """Check if an error means the container no longer exists"""
+        if isinstance(error, ContainerNotFoundError):
+            return True
+
+        return isinstance(error, PortainerHTTPError) and error.status_code == 404
 
+    def _loop(self):
+        """Sleep until the scheduled time and restart the container, forever"""
         while True:
+            # A single timestamp is used for the whole check
+            now = datetime.now()
             try:
-                # Resolve container ID if not already done
-                if not self.container_id:
-                    self.container_id = self.api.get_container_id(
-                        self.endpoint_id,
-                        self.container_name
+                if self._should_restart(now):
+                    self._do_restart(now)
+                elif logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(
+                        "Next restart at %s, currently %s",
+                        self.restart_time,
+                        now.strftime('%H:%M')
                     )
-                    logger.info(f"Resolved container ID: {self.container_id[:12]}...")
 
-                if self._should_restart():
-                    logger.info(f"Time to restart container {self.container_name}")
-                    self.api.restart_container(self.endpoint_id, self.container_id)
-                    self.last_restart_date = datetime.now().date()
-                    logger.info(f"Next restart scheduled for {self.restart_time} tomorrow")
-                else:
-                    next_run = datetime.strptime(self.restart_time, '%H:%M').time()
-                    logger.debug(f"Next restart at {next_run}, currently {datetime.now().strftime('%H:%M')}")
+                self._fail_count = 0
+                # Wake up at the scheduled time, or after an hour at most
+                sleep_for = min(self._seconds_until_next_restart(now), MAX_SLEEP)
 
             except Exception as e:
-                logger.error(f"Error in main loop: {e}")
-                # Reset container_id to retry resolution
-                self.container_id = None
-
-            time.sleep(self.check_interval)
+                logger.error("Error in main loop: %s", e)
+                # Only re-resolve the container ID if the container is gone
+                if self._is_not_found(e):
+                    self.container_id = None
+                # Back off so an outage doesn't turn into a stream of requests
+                sleep_for = min(
+                    self.check_interval * 2 ** self._fail_count,
+                    max(self.check_interval, MAX_BACKOFF)
+                )
+                self._fail_count += 1
+
+            time.sleep(sleep_for)
 
 
 def main():